@@ -131,6 +131,10 @@ def _log(message, level, *args, **kwargs):
         MSG(msg_format(message, *args, **kwargs), level=level).display()
 
 
+def debug_enabled():
+    return LOG_LEVEL <= LOG_LEVELS['DEBUG']
+
+
 def debug(message, *args, **kwargs):
     _log(message, LOG_LEVELS['DEBUG'], *args, **kwargs)
 
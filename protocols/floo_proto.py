@@ -1,7 +1,7 @@
 import sys
 import socket
-import select
 import collections
+import itertools
 import json
 import errno
 import os.path
@@ -12,6 +12,12 @@ try:
 except ImportError:
     ssl = False
 
+try:
+    import orjson
+    assert orjson
+except ImportError:
+    orjson = False
+
 try:
     from ... import editor
     from .. import api, cert, msg, shared as G, utils
@@ -34,8 +40,36 @@ except Exception:
     iscon_errno = errno.EISCONN
     write_again_errno = (errno.EWOULDBLOCK, errno.EAGAIN) + connect_errno
 
+connect_errno = frozenset(connect_errno)
+write_again_errno = frozenset(write_again_errno)
+
 
 PY2 = sys.version_info < (3, 0)
+CA_CERT_BYTES = cert.CA_CERT.encode('utf-8')
+# json.loads() only takes bytes on Python 3.6+ (Python 2 strs are bytes)
+JSON_LOADS_BYTES = PY2 or sys.version_info >= (3, 6)
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+# sysconf returns -1 when there's no fixed limit
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+try:
+    memoryview
+    HAS_MEMORYVIEW = True
+except NameError:
+    # Python 2.6 (Sublime Text 2)
+    HAS_MEMORYVIEW = False
+
+
+def buf_tail(buf, start):
+    # Slicing a memoryview doesn't copy, so a big message can be sent in pieces without quadratic copying
+    if HAS_MEMORYVIEW:
+        return memoryview(buf)[start:]
+    return buf[start:]
 
 
 def sock_debug(*args, **kwargs):
@@ -43,10 +77,44 @@ def sock_debug(*args, **kwargs):
         msg.log(*args, **kwargs)
 
 
+def encode_json(item):
+    if orjson:
+        try:
+            # Let orjson write the newline into its own output buffer instead of copying the message to add it
+            if hasattr(orjson, 'OPT_APPEND_NEWLINE'):
+                return orjson.dumps(item, option=orjson.OPT_APPEND_NEWLINE)
+            return orjson.dumps(item) + b'\n'
+        except TypeError:
+            # orjson is stricter about what it serializes (eg: non-str dict keys)
+            pass
+    return (json.dumps(item, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def decode_json(frame):
+    if orjson:
+        try:
+            return orjson.loads(frame)
+        except ValueError:
+            # Invalid UTF-8 or something orjson won't parse (eg: NaN). Let the slow path have a go.
+            pass
+    elif JSON_LOADS_BYTES:
+        try:
+            # json validates UTF-8 itself, so valid frames skip a separate decode pass
+            return json.loads(bytes(frame) if PY2 else frame)
+        except UnicodeDecodeError:
+            pass
+    # Node.js sends invalid utf8 even though we're calling write(string, "utf8")
+    # Python 2 can figure it out, but python 3 hates it and will die here with some byte sequences
+    # Instead of crashing the plugin, we drop the data. Yes, this is horrible.
+    return json.loads(frame.decode('utf-8', 'ignore'))
+
+
 class FlooProtocol(base.BaseProtocol):
     ''' Base FD Interface'''
     MAX_RETRIES = 13
     INITIAL_RECONNECT_DELAY = 500
+    # Set once the CA cert has been written this process. No need to rewrite it on every reconnect.
+    _ca_written = False
 
     def __init__(self, host, port, secure=True):
         super(FlooProtocol, self).__init__(host, port, secure)
@@ -54,15 +122,23 @@ class FlooProtocol(base.BaseProtocol):
         self.connected = False
         self._needs_handshake = bool(secure)
         self._sock = None
+        self._fileno = None
+        # Waiting on a non-blocking connect()
+        self._connecting = False
+        self._connect_timeout = None
         self._q = collections.deque()
         self._slice = bytes()
-        self._buf_in = bytes()
-        self._buf_out = bytes()
+        self._buf_in = bytearray()
+        self._buf_in_off = 0
+        # Everything before this has already been searched for a newline
+        self._buf_in_scan = 0
         self._reconnect_delay = self.INITIAL_RECONNECT_DELAY
         self._retries = self.MAX_RETRIES
         self._empty_reads = 0
         self._reconnect_timeout = None
         self._cert_path = os.path.join(G.BASE_DIR, 'floobits.pem')
+        self._ssl_ctx = None
+        self._ssl_session = None
         self.req_id = 0
 
         self._host = host
@@ -77,6 +153,11 @@ class FlooProtocol(base.BaseProtocol):
             self._port = None
             self._secure = False
 
+    @property
+    def _sendmsg(self):
+        # SSLSocket.sendmsg() raises NotImplementedError, and Python 2 has no sendmsg at all.
+        return not self._secure and hasattr(self._sock, 'sendmsg')
+
     @property
     def retry_count(self):
         return self.MAX_RETRIES - self._retries
@@ -87,93 +168,178 @@ class FlooProtocol(base.BaseProtocol):
             msg.log('SSL proxy in debug mode: Port is set to %s' % self._port)
             return
         args = ('python', '-m', 'floo.proxy', '--host=%s' % host, '--port=%s' % str(port), '--ssl=%s' % str(bool(self.secure)))
+        # The proxy outlives reconnects. Only respawn it if it died or has to point somewhere else.
+        if self._proc is not None and self._proc.is_running() and self._proc.args == args:
+            return self._port
+        self.stop_proxy()
 
         self._proc = proxy.ProxyProtocol()
         self._proc.once('stop', self.reconnect)
         self._port = self._proc.connect(args)
         return self._port
 
+    def stop_proxy(self):
+        if self._proc is None:
+            return
+        self._proc.cleanup()
+        self._proc = None
+
     def _handle(self, data):
         self._buf_in += data
         if self._handling:
             return
         self._handling = True
-        while True:
-            before, sep, after = self._buf_in.partition(b'\n')
-            if not sep:
+        buf_in = self._buf_in
+        while self._buf_in is buf_in:
+            # Only search bytes we haven't searched yet. A big message arriving in pieces would otherwise be rescanned each time.
+            end = buf_in.rfind(b'\n', max(self._buf_in_scan, self._buf_in_off))
+            self._buf_in_scan = len(buf_in)
+            if end < 0:
                 break
-            try:
-                # Node.js sends invalid utf8 even though we're calling write(string, "utf8")
-                # Python 2 can figure it out, but python 3 hates it and will die here with some byte sequences
-                # Instead of crashing the plugin, we drop the data. Yes, this is horrible.
-                before = before.decode('utf-8', 'ignore')
-                data = json.loads(before)
-            except Exception as e:
-                msg.error('Unable to parse json: ', str_e(e))
-                msg.error('Data: ', before)
-                # XXXX: THIS LOSES DATA
-                self._buf_in = after
-                continue
-
-            name = data.get('name')
-            self._buf_in = after
-            try:
-                msg.debug('got data ' + (name or 'no name'))
-                self.emit('data', name, data)
-            except Exception as e:
-                api.send_error('Error handling %s event.' % name, str_e(e))
-                if name == 'room_info':
-                    editor.error_message('Error joining workspace: %s' % str_e(e))
-                    self.stop()
+            # Split out every complete message at once rather than searching for each newline
+            frames = buf_in[self._buf_in_off:end].split(b'\n')
+            self._buf_in_off = end + 1
+            for before in frames:
+                if self._buf_in is not buf_in:
+                    # cleanup() was called by a handler. The rest is from the old connection.
+                    break
+                try:
+                    data = decode_json(before)
+                except Exception as e:
+                    msg.error('Unable to parse json: ', str_e(e))
+                    msg.error('Data: ', before.decode('utf-8', 'replace'))
+                    # XXXX: THIS LOSES DATA
+                    continue
+
+                name = data.get('name')
+                try:
+                    if msg.debug_enabled():
+                        msg.debug('got data ' + (name or 'no name'))
+                    self.emit('data', name, data)
+                except Exception as e:
+                    api.send_error('Error handling %s event.' % name, str_e(e))
+                    if name == 'room_info':
+                        editor.error_message('Error joining workspace: %s' % str_e(e))
+                        self.stop()
+        if self._buf_in is buf_in:
+            # Only shift the buffer down once enough consumed data has piled up in front of it.
+            if self._buf_in_off == len(buf_in):
+                del buf_in[:]
+                self._buf_in_off = 0
+                self._buf_in_scan = 0
+            elif self._buf_in_off > 65536:
+                del buf_in[:self._buf_in_off]
+                self._buf_in_scan -= self._buf_in_off
+                self._buf_in_off = 0
         self._handling = False
 
-    def _connect(self, host, port, attempts=0):
-        if attempts > (self.proxy and 500 or 500):
-            msg.error('Connection attempt timed out.')
-            return self.reconnect()
+    def _connect(self, host, port):
         if not self._sock:
             msg.debug('_connect: No socket')
             return
         try:
             self._sock.connect((host, port))
-            select.select([self._sock], [self._sock], [], 0)
         except socket.error as e:
-            if e.errno == iscon_errno:
+            eno = e.errno
+            if eno == iscon_errno:
                 pass
-            elif e.errno in connect_errno:
+            elif eno in connect_errno:
+                # The socket becomes writeable once the connect finishes. write() picks it up from there.
                 msg.debug('connect_errno: ', str_e(e))
-                return utils.set_timeout(self._connect, 20, host, port, attempts + 1)
+                self._connecting = True
+                self._connect_timeout = utils.set_timeout(self._on_connect_timeout, 10000)
+                return
             else:
                 msg.error('Error connecting: ', str_e(e))
                 return self.reconnect()
+        self._on_connect()
+
+    def _finish_connect(self):
+        self._connecting = False
+        utils.cancel_timeout(self._connect_timeout)
+        self._connect_timeout = None
+        err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            msg.error('Error connecting: ', os.strerror(err))
+            return self.reconnect()
+        self._on_connect()
+
+    def _on_connect_timeout(self):
+        self._connect_timeout = None
+        msg.error('Connection attempt timed out.')
+        self.reconnect()
+
+    def _on_connect(self):
         if self._secure:
             sock_debug('SSL-wrapping socket')
-            cert_reqs = ssl.CERT_REQUIRED
-            if G.INSECURE_SSL:
-                cert_reqs = ssl.CERT_NONE
-            self._sock = ssl.wrap_socket(self._sock, ca_certs=self._cert_path, cert_reqs=cert_reqs, do_handshake_on_connect=False)
+            self._sock = self._wrap_socket(self._sock)
 
         self._q.clear()
-        self._buf_out = bytes()
+        self._slice = bytes()
         self.emit('connect')
         self.connected = True
 
+    def _ssl_context(self):
+        # Reused across reconnects so the CA file is only loaded once. Rebuilt if insecure_ssl gets changed
+        # by a settings reload.
+        insecure = bool(G.INSECURE_SSL)
+        if self._ssl_ctx and self._ssl_ctx[0] == insecure:
+            return self._ssl_ctx[1]
+        # Sessions can't be resumed on a different context
+        self._ssl_session = None
+        ctx = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+        if insecure:
+            if hasattr(ctx, 'check_hostname'):
+                ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        else:
+            ctx.verify_mode = ssl.CERT_REQUIRED
+            ctx.load_verify_locations(self._cert_path)
+            if hasattr(ctx, 'check_hostname'):
+                ctx.check_hostname = ssl.HAS_SNI
+        self._ssl_ctx = (insecure, ctx)
+        return ctx
+
+    def _wrap_socket(self, sock):
+        if not hasattr(ssl, 'SSLContext'):
+            cert_reqs = ssl.CERT_REQUIRED
+            if G.INSECURE_SSL:
+                cert_reqs = ssl.CERT_NONE
+            return ssl.wrap_socket(sock, ca_certs=self._cert_path, cert_reqs=cert_reqs, do_handshake_on_connect=False)
+
+        ctx = self._ssl_context()
+        kwargs = {'do_handshake_on_connect': False}
+        # Verify the workspace host, not proxy.floobits.com when outbound filtering is on
+        if ssl.HAS_SNI:
+            kwargs['server_hostname'] = self._host
+        # Resume the last session so reconnects can skip a full handshake (Python 3.6+)
+        if self._ssl_session is not None:
+            kwargs['session'] = self._ssl_session
+        return ctx.wrap_socket(sock, **kwargs)
+
     def __len__(self):
         return len(self._q)
 
     def fileno(self):
-        return self._sock and self._sock.fileno()
+        return self._fileno
 
     def fd_set(self, readable, writeable, errorable):
+        fileno = self._fileno
+        if fileno is None:
+            return
+
+        if self._connecting:
+            errorable.append(fileno)
+            return writeable.append(fileno)
+
         if not self.connected:
             return
 
-        fileno = self.fileno()
         errorable.append(fileno)
 
         if self._needs_handshake:
             return writeable.append(fileno)
-        elif len(self) > 0 or self._buf_out:
+        elif self._q or self._slice:
             writeable.append(fileno)
 
         readable.append(fileno)
@@ -192,19 +358,27 @@ class FlooProtocol(base.BaseProtocol):
 
         # TODO: Horrible code here
         if self.proxy:
-            if G.OUTBOUND_FILTERING:
-                port = self.start_proxy(G.OUTBOUND_FILTER_PROXY_HOST, G.OUTBOUND_FILTER_PROXY_PORT)
-            else:
-                port = self.start_proxy(self.host, self.port)
+            try:
+                if G.OUTBOUND_FILTERING:
+                    port = self.start_proxy(G.OUTBOUND_FILTER_PROXY_HOST, G.OUTBOUND_FILTER_PROXY_PORT)
+                else:
+                    port = self.start_proxy(self.host, self.port)
+            except Exception as e:
+                # We're usually called from the reconnect timer. Don't let a slow proxy end the retries.
+                msg.error('Error starting Floobits SSL proxy: ', str_e(e))
+                return self.reconnect()
         elif G.OUTBOUND_FILTERING:
             host = G.OUTBOUND_FILTER_PROXY_HOST
             port = G.OUTBOUND_FILTER_PROXY_PORT
 
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._sock.setblocking(False)
-        if self._secure:
+        # Cached so the reactor doesn't have to ask the socket for it every tick
+        self._fileno = self._sock.fileno()
+        if self._secure and not (FlooProtocol._ca_written and os.path.exists(self._cert_path)):
             with open(self._cert_path, 'wb') as cert_fd:
-                cert_fd.write(cert.CA_CERT.encode('utf-8'))
+                cert_fd.write(CA_CERT_BYTES)
+            FlooProtocol._ca_written = True
         conn_msg = '%s:%s: Connecting...' % (self.host, self.port)
         if self.retry_count != 0:
             conn_msg += ' (attempt %s) ' % (self.retry_count + 1)
@@ -217,25 +391,32 @@ class FlooProtocol(base.BaseProtocol):
         self._connect(host, port)
 
     def cleanup(self, *args, **kwargs):
-        try:
-            self._sock.shutdown(2)
-        except Exception:
-            pass
-        try:
-            self._sock.close()
-        except Exception:
-            pass
-        try:
-            self._proc.cleanup()
-        except Exception:
-            pass
+        # reconnect() and connect() both clean up. Don't redo it (or re-emit) if there's nothing to clean.
+        if self._sock is None and not self.connected and not self._buf_in:
+            return
+        if self._sock is not None:
+            session = getattr(self._sock, 'session', None)
+            if session is not None and not self._needs_handshake:
+                self._ssl_session = session
+            try:
+                self._sock.shutdown(2)
+            except socket.error:
+                pass
+            try:
+                self._sock.close()
+            except socket.error:
+                pass
         self._slice = bytes()
-        self._buf_in = bytes()
-        self._buf_out = bytes()
+        self._buf_in = bytearray()
+        self._buf_in_off = 0
+        self._buf_in_scan = 0
         self._sock = None
+        self._fileno = None
         self._needs_handshake = self._secure
+        self._connecting = False
+        utils.cancel_timeout(self._connect_timeout)
+        self._connect_timeout = None
         self.connected = False
-        self._proc = None
         self.emit('cleanup')
 
     def _do_ssl_handshake(self):
@@ -262,44 +443,82 @@ class FlooProtocol(base.BaseProtocol):
 
     def write(self):
         sock_debug('Socket is writeable')
+        if self._connecting:
+            return self._finish_connect()
         if self._needs_handshake and not self._do_ssl_handshake():
             return
 
-        total = 0
-        if not self._slice:
-            self._slice = self._buf_out[total:total + 65536]
+        if self._sendmsg and not self._slice:
+            return self._write_sendmsg()
+
         try:
             while True:
-                if total < len(self._buf_out) or self._slice:
-                    sent = self._sock.send(self._slice)
+                if not self._slice:
+                    self._slice = self._next_slice()
+                    if not self._slice:
+                        break
+                sent = self._sock.send(self._slice)
+                if G.SOCK_DEBUG:
                     sock_debug('Sent %s bytes. Last 10 bytes were %s' % (sent, self._slice[-10:]))
-                    if not sent:
-                        raise IndexError('LOL')
-                    total += sent
-                    self._slice = self._buf_out[total:total + 65536]
-                else:
-                    self._buf_out = self._q.popleft().encode('utf-8')
-                    total = 0
-                    self._slice = self._buf_out[total:total + 65536]
-        except IndexError:
-            pass
+                if not sent:
+                    break
+                self._slice = self._slice[sent:]
+        except socket.error as e:
+            if e.errno not in write_again_errno:
+                raise
+        sock_debug('Done writing for now')
+
+    def _next_slice(self):
+        # Take up to 64KB off the front of the queue. SSL needs the same buffer on retry, so this stays in
+        # self._slice until it's fully sent.
+        q = self._q
+        chunks = []
+        size = 0
+        while q and size < 65536:
+            item = q.popleft()
+            room = 65536 - size
+            if len(item) > room:
+                q.appendleft(buf_tail(item, room))
+                item = item[:room]
+            if not isinstance(item, bytes):
+                item = item.tobytes()
+            chunks.append(item)
+            size += len(item)
+        return b''.join(chunks)
+
+    def _write_sendmsg(self):
+        # Plain sockets: scatter-gather from the front of the queue, IOV_MAX buffers per syscall.
+        q = self._q
+        try:
+            while q:
+                sent = self._sock.sendmsg(list(itertools.islice(q, IOV_MAX)))
+                if G.SOCK_DEBUG:
+                    sock_debug('Sent %s bytes' % sent)
+                if not sent:
+                    break
+                while sent:
+                    n = len(q[0])
+                    if sent < n:
+                        q[0] = buf_tail(q[0], sent)
+                        break
+                    sent -= n
+                    q.popleft()
         except socket.error as e:
             if e.errno not in write_again_errno:
                 raise
-        self._buf_out = self._buf_out[total:]
         sock_debug('Done writing for now')
 
     def read(self):
         sock_debug('Socket is readable')
         if self._needs_handshake and not self._do_ssl_handshake():
             return
-        buf = ''.encode('utf-8')
+        chunks = []
         while True:
             try:
                 d = self._sock.recv(65536)
                 if not d:
                     break
-                buf += d
+                chunks.append(d)
                 # ST2 on Windows with Package Control 3 support!
                 # (socket.recv blocks for some damn reason)
                 if G.SOCK_SINGLE_READ:
@@ -311,10 +530,10 @@ class FlooProtocol(base.BaseProtocol):
                 sock_debug('Socket error:', e)
                 break
 
-        if buf:
+        if chunks:
             self._empty_reads = 0
             # sock_debug('read data')
-            return self._handle(buf)
+            return self._handle(b''.join(chunks))
 
         sock_debug('empty select')
         self._empty_reads += 1
@@ -330,6 +549,7 @@ class FlooProtocol(base.BaseProtocol):
         utils.cancel_timeout(self._reconnect_timeout)
         self._reconnect_timeout = None
         self.cleanup()
+        self.stop_proxy()
         self.emit('stop')
         msg.log('Disconnected.')
 
@@ -360,8 +580,9 @@ class FlooProtocol(base.BaseProtocol):
             return
         self.req_id += 1
         item['req_id'] = self.req_id
-        msg.debug('writing ', item.get('name', 'NO NAME'),
-                  ' req_id ', self.req_id,
-                  ' qsize ', len(self))
-        self._q.append(json.dumps(item) + '\n')
+        if msg.debug_enabled():
+            msg.debug('writing ', item.get('name', 'NO NAME'),
+                      ' req_id ', self.req_id,
+                      ' qsize ', len(self))
+        self._q.append(encode_json(item))
         return self.req_id
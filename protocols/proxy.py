@@ -1,5 +1,6 @@
 import subprocess
 import re
+import select
 import os.path
 
 try:
@@ -13,6 +14,8 @@ try:
 except (ImportError, ValueError):
     from floo.common import event_emitter, msg, shared as G
 
+PORT_RE = re.compile(r'Now listening on <(\d+)>')
+
 
 class ProxyProtocol(event_emitter.EventEmitter):
     ''' Base Proxy Interface'''
@@ -44,8 +47,12 @@ class ProxyProtocol(event_emitter.EventEmitter):
             pass
         self.fd = None
         self._proc = None
+        self.args = None
         self.buf = [b'']
 
+    def is_running(self):
+        return self._proc is not None and self._proc.poll() is None
+
     def read(self):
         if self.fd is None:
             msg.debug('self.fd is None. Read called after cleanup.')
@@ -85,13 +92,18 @@ class ProxyProtocol(event_emitter.EventEmitter):
     def connect(self, args):
         msg.debug('Running proxy with args ', args, ' in ', G.PLUGIN_PATH)
         self._proc = proc = subprocess.Popen(args, cwd=G.PLUGIN_PATH, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.args = args
+        # Don't hang forever if the proxy never tells us its port
+        if not select.select([proc.stdout], [], [], 5)[0]:
+            self.cleanup()
+            raise Exception('Timed out waiting for Floobits SSL proxy to start')
         line = proc.stdout.readline().decode('utf-8')
         self.fd = proc.stdout.fileno()
         fl = fcntl.fcntl(self.fd, fcntl.F_GETFL)
         fcntl.fcntl(self.fd, fcntl.F_SETFL, fl | os.O_NONBLOCK | os.O_ASYNC)
 
         msg.log('Read line from Floobits SSL proxy: ', line)
-        match = re.search('Now listening on <(\d+)>', line)
+        match = PORT_RE.search(line)
         if not match:
             raise Exception("Couldn't find port in line from proxy: %s" % line)
         self._port = int(match.group(1))
@@ -43,6 +43,7 @@ class ProxyProtocol(floo_proto.FlooProtocol):
     def connect(self, sock=None):
         self.emit('connected')
         self._sock = sock
+        self._fileno = sock.fileno()
         self.connected = True
 
     def reconnect(self):